@@ -101,6 +101,8 @@ def find_tests(which_tests=None, exclude_tests=None):
         a(test_parse_fields(return_tests=True))
         from calibre.ebooks.docx.writer.utils import test_convert_color
         a(test_convert_color(return_tests=True))
+        from calibre.ebooks.docx.tables import test_tables
+        a(test_tables(return_tests=True))
     if ok('cfi'):
         from calibre.ebooks.epub.cfi.tests import find_tests
         a(find_tests())
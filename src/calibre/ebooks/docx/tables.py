@@ -5,161 +5,265 @@
 __license__ = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
-from lxml.html.builder import TABLE, TR, TD
+import sys
 
-from calibre.ebooks.docx.block_styles import inherit, read_shd as rs, read_border, binary_property, border_props, ParagraphStyle, border_to_css
+from lxml.etree import SubElement
+
+from calibre.ebooks.docx.block_styles import (
+    inherit, read_shd as rs, read_border, read_single_border, binary_property, border_props, ParagraphStyle, border_to_css, simple_color)
 from calibre.ebooks.docx.char_styles import RunStyle
 from polyglot.builtins import filter, iteritems, itervalues, range, unicode_type
+from polyglot.functools import lru_cache
 
 # Read from XML {{{
 read_shd = rs
 edges = ('left', 'top', 'right', 'bottom')
+padding_attrs = tuple((x, sys.intern('cell_padding_' + x)) for x in edges)
 
 
-def _read_width(elem, get):
-    ans = inherit
+def namespace_of(elem):
+    # The namespace of elem as a {namespace} prefix. Attributes of
+    # WordprocessingML elements are looked up directly using this prefix,
+    # rather than through DOCXNamespace.get() which has to expand the
+    # w: prefix on every call.
+    tag = elem.tag
+    return tag[:tag.index('}') + 1]
+
+
+def children(parent, name, reversed=False):
+    # Iterate over the child elements of parent with the specified local name.
+    # Much faster than XPath for simple child steps. The namespace is taken
+    # from parent so that both transitional and strict documents work.
+    return parent.iterchildren(namespace_of(parent) + name, reversed=reversed)
+
+
+def child(parent, name):
+    # The last child element of parent with the specified local name or None.
+    # When an element is repeated, the last one wins, as Word does.
+    # Faster than parent.find() which goes through ElementPath.
+    return next(children(parent, name, reversed=True), None)
+
+
+def _read_width(elem, ns):
     try:
-        w = int(get(elem, 'w:w'))
+        w = int(elem.get(ns + 'w'))
     except (TypeError, ValueError):
         w = 0
-    typ = get(elem, 'w:type', 'auto')
+    return _compute_width(elem.get(ns + 'type', 'auto'), w)
+
+
+@lru_cache(maxsize=4096)
+def _compute_width(typ, w):
+    # Tables typically use only a handful of distinct widths, so cache the
+    # formatted values
+    ans = inherit
     if typ == 'nil':
         ans = '0'
     elif typ == 'auto':
         ans = 'auto'
     elif typ == 'dxa':
-        ans = '%.3gpt' % (w/20)
+        q, r = divmod(w, 20)
+        # Most widths are whole points, for which %d gives the same result as %.3g
+        ans = '%dpt' % q if r == 0 and -1000 < q < 1000 else '%.3gpt' % (w/20)
     elif typ == 'pct':
-        ans = '%.3g%%' % (w/50)
+        q, r = divmod(w, 50)
+        ans = '%d%%' % q if r == 0 and -1000 < q < 1000 else '%.3g%%' % (w/50)
     return ans
 
 
 def read_width(parent, dest, XPath, get):
-    ans = inherit
-    for tblW in XPath('./w:tblW')(parent):
-        ans = _read_width(tblW, get)
-    setattr(dest, 'width', ans)
-
-
-def read_cell_width(parent, dest, XPath, get):
-    ans = inherit
-    for tblW in XPath('./w:tcW')(parent):
-        ans = _read_width(tblW, get)
-    setattr(dest, 'width', ans)
+    tblW = child(parent, 'tblW')
+    setattr(dest, 'width', inherit if tblW is None else _read_width(tblW, namespace_of(tblW)))
 
 
 def read_padding(parent, dest, XPath, get):
-    name = 'tblCellMar' if parent.tag.endswith('}tblPr') else 'tcMar'
-    ans = {x:inherit for x in edges}
-    for mar in XPath('./w:%s' % name)(parent):
+    # Only used for w:tblPr, w:tcMar is handled by read_cell_properties()
+    ans = None
+    for mar in children(parent, 'tblCellMar'):
+        if ans is None:
+            ans = dict.fromkeys(edges, inherit)
         for x in edges:
-            for edge in XPath('./w:%s' % x)(mar):
-                ans[x] = _read_width(edge, get)
-    for x in edges:
-        setattr(dest, 'cell_padding_%s' % x, ans[x])
+            for edge in children(mar, x):
+                ans[x] = _read_width(edge, namespace_of(edge))
+    if ans is None:
+        # No margins specified, the common case
+        for x, attr in padding_attrs:
+            setattr(dest, attr, inherit)
+    else:
+        for x, attr in padding_attrs:
+            setattr(dest, attr, ans[x])
+
+
+# Map of the value of w:jc to (margin_left, margin_right)
+justification_map = {'left': (inherit, 'auto'), 'right': ('auto', inherit), 'center': ('auto', 'auto')}
 
 
 def read_justification(parent, dest, XPath, get):
     left = right = inherit
-    for jc in XPath('./w:jc[@w:val]')(parent):
-        val = get(jc, 'w:val')
-        if not val:
-            continue
-        if val == 'left':
-            right = 'auto'
-        elif val == 'right':
-            left = 'auto'
-        elif val == 'center':
-            left = right = 'auto'
+    val_attr = namespace_of(parent) + 'val'
+    # The last w:jc with a recognized value wins
+    for jc in children(parent, 'jc', reversed=True):
+        ans = justification_map.get(jc.get(val_attr))
+        if ans is not None:
+            left, right = ans
+            break
     setattr(dest, 'margin_left', left)
     setattr(dest, 'margin_right', right)
 
 
 def read_spacing(parent, dest, XPath, get):
-    ans = inherit
-    for cs in XPath('./w:tblCellSpacing')(parent):
-        ans = _read_width(cs, get)
-    setattr(dest, 'spacing', ans)
+    cs = child(parent, 'tblCellSpacing')
+    setattr(dest, 'spacing', inherit if cs is None else _read_width(cs, namespace_of(cs)))
 
 
 def read_float(parent, dest, XPath, get):
     ans = inherit
-    for x in XPath('./w:tblpPr')(parent):
+    for x in children(parent, 'tblpPr'):
         ans = {k.rpartition('}')[-1]: v for k, v in iteritems(x.attrib)}
     setattr(dest, 'float', ans)
 
 
 def read_indent(parent, dest, XPath, get):
-    ans = inherit
-    for cs in XPath('./w:tblInd')(parent):
-        ans = _read_width(cs, get)
-    setattr(dest, 'indent', ans)
+    ind = child(parent, 'tblInd')
+    setattr(dest, 'indent', inherit if ind is None else _read_width(ind, namespace_of(ind)))
 
 
 border_edges = ('left', 'top', 'right', 'bottom', 'insideH', 'insideV')
+# The property names are interned as they are used for attribute access and
+# as dictionary keys in hot loops, interned names compare by identity
+border_properties = tuple(sys.intern(k % edge) for edge in border_edges for k in border_props)
+# For every border edge, pairs of the keys returned by read_single_border()
+# and the corresponding property names
+edge_border_properties = tuple((edge, tuple((k, sys.intern(k % edge)) for k in border_props)) for edge in border_edges)
+# For every cell edge, the cell padding property and pairs of the border
+# properties for that edge and for the corresponding inside edge
+cell_edge_properties = tuple(
+    (x, sys.intern('cell_padding_' + x), tuple(
+        (sys.intern(k % x), sys.intern(k % ('insideH' if x in {'top', 'bottom'} else 'insideV'))) for k in border_props if k.startswith('border')))
+    for x in edges)
 
 
 def read_borders(parent, dest, XPath, get):
-    name = 'tblBorders' if parent.tag.endswith('}tblPr') else 'tcBorders'
-    read_border(parent, dest, XPath, get, border_edges, name)
+    # Only used for w:tblPr, w:tcBorders is handled by read_cell_properties()
+    read_border(parent, dest, XPath, get, border_edges, 'tblBorders')
 
 
 def read_height(parent, dest, XPath, get):
     ans = inherit
-    for rh in XPath('./w:trHeight')(parent):
-        rule = get(rh, 'w:hRule', 'auto')
+    ns = namespace_of(parent)
+    for rh in children(parent, 'trHeight', reversed=True):
+        rule = rh.get(ns + 'hRule', 'auto')
         if rule in {'auto', 'atLeast', 'exact'}:
-            val = get(rh, 'w:val')
-            ans = (rule, val)
+            ans = (rule, rh.get(ns + 'val'))
+            break
     setattr(dest, 'height', ans)
 
 
-def read_vertical_align(parent, dest, XPath, get):
-    ans = inherit
-    for va in XPath('./w:vAlign')(parent):
-        val = get(va, 'w:val')
-        ans = {'center': 'middle', 'top': 'top', 'bottom': 'bottom'}.get(val, 'middle')
-    setattr(dest, 'vertical_align', ans)
-
-
-def read_col_span(parent, dest, XPath, get):
-    ans = inherit
-    for gs in XPath('./w:gridSpan')(parent):
+def _read_band_size(parent, name, val_attr):
+    ans = 1
+    for y in children(parent, name):
         try:
-            ans = int(get(gs, 'w:val'))
+            ans = int(y.get(val_attr))
         except (TypeError, ValueError):
             continue
-    setattr(dest, 'col_span', ans)
-
-
-def read_merge(parent, dest, XPath, get):
-    for x in ('hMerge', 'vMerge'):
-        ans = inherit
-        for m in XPath('./w:%s' % x)(parent):
-            ans = get(m, 'w:val', 'continue')
-        setattr(dest, x, ans)
+    return ans
 
 
 def read_band_size(parent, dest, XPath, get):
-    for x in ('Col', 'Row'):
-        ans = 1
-        for y in XPath('./w:tblStyle%sBandSize' % x)(parent):
-            try:
-                ans = int(get(y, 'w:val'))
-            except (TypeError, ValueError):
-                continue
-        setattr(dest, '%s_band_size' % x.lower(), ans)
+    val_attr = namespace_of(parent) + 'val'
+    setattr(dest, 'col_band_size', _read_band_size(parent, 'tblStyleColBandSize', val_attr))
+    setattr(dest, 'row_band_size', _read_band_size(parent, 'tblStyleRowBandSize', val_attr))
 
 
 def read_look(parent, dest, XPath, get):
     ans = 0
-    for x in XPath('./w:tblLook')(parent):
+    val_attr = namespace_of(parent) + 'val'
+    for x in children(parent, 'tblLook', reversed=True):
         try:
-            ans = int(get(x, 'w:val'), 16)
+            ans = int(x.get(val_attr), 16)
         except (ValueError, TypeError):
             continue
+        break
     setattr(dest, 'look', ans)
 
+
+row_readers = (read_spacing, read_height)
+table_readers = (
+    read_width, read_float, read_padding, read_shd, read_justification, read_spacing, read_indent, read_borders, read_band_size, read_look)
+
+
+# Cells are by far the most numerous table objects, so rather than running a
+# separate reader, each scanning the children of tcPr, per property, cell
+# properties are read in a single pass over the children of tcPr, dispatching
+# on the tag. The properties must be initialized to inherit before calling
+# read_cell_properties().
+
+def cell_width(tcW, dest, ns, XPath, get):
+    dest.width = _read_width(tcW, ns)
+
+
+def cell_borders(tcBorders, dest, ns, XPath, get):
+    for edge, props in edge_border_properties:
+        vals = read_single_border(tcBorders, edge, XPath, get)
+        for k, prop in props:
+            val = vals[k]
+            if val is not None:
+                setattr(dest, prop, val)
+
+
+def cell_shd(shd, dest, ns, XPath, get):
+    val = shd.get(ns + 'fill')
+    if val:
+        dest.background_color = simple_color(val, auto='transparent')
+
+
+def cell_padding(tcMar, dest, ns, XPath, get):
+    for x, attr in padding_attrs:
+        for edge in tcMar.iterchildren(ns + x):
+            setattr(dest, attr, _read_width(edge, ns))
+
+
+vertical_align_map = {'center': 'middle', 'top': 'top', 'bottom': 'bottom'}
+
+
+def cell_vertical_align(vAlign, dest, ns, XPath, get):
+    dest.vertical_align = vertical_align_map.get(vAlign.get(ns + 'val'), 'middle')
+
+
+def cell_col_span(gridSpan, dest, ns, XPath, get):
+    try:
+        dest.col_span = int(gridSpan.get(ns + 'val'))
+    except (TypeError, ValueError):
+        pass
+
+
+def cell_h_merge(hMerge, dest, ns, XPath, get):
+    dest.hMerge = hMerge.get(ns + 'val', 'continue')
+
+
+def cell_v_merge(vMerge, dest, ns, XPath, get):
+    dest.vMerge = vMerge.get(ns + 'val', 'continue')
+
+
+cell_property_readers = {
+    'tcW': cell_width, 'tcBorders': cell_borders, 'shd': cell_shd, 'tcMar': cell_padding,
+    'vAlign': cell_vertical_align, 'gridSpan': cell_col_span, 'hMerge': cell_h_merge, 'vMerge': cell_v_merge,
+}
+
+
+@lru_cache(maxsize=2)
+def namespaced_cell_property_readers(ns):
+    return {ns + name: f for name, f in iteritems(cell_property_readers)}
+
+
+def read_cell_properties(tcPr, dest, XPath, get):
+    ns = namespace_of(tcPr)
+    readers = namespaced_cell_property_readers(ns)
+    for elem in tcPr.iterchildren():
+        f = readers.get(elem.tag)
+        if f is not None:
+            f(elem, dest, ns, XPath, get)
+
 # }}}
 
 
@@ -176,13 +280,33 @@ def clone(style):
 
 class Style(object):
 
-    is_bidi = False
+    # The style classes use __slots__ as very large documents can have tens
+    # of thousands of cell styles
+    __slots__ = ('namespace', 'is_bidi', '_css', 'defined_mask')
+
+    def init_defined_mask(self):
+        # A bitmask of the properties that are not inherit, so that update()
+        # and resolve_based_on() only have to visit those. Invariant: bit i is
+        # set if and only if all_properties[i] is not inherit. Code that
+        # assigns properties directly, rather than via update() or
+        # copy_properties(), must call this afterwards.
+        mask = 0
+        for i, prop in enumerate(self.all_properties):
+            if getattr(self, prop) is not inherit:
+                mask |= 1 << i
+        self.defined_mask = mask
+
+    def copy_properties(self, other, mask):
+        self.defined_mask |= mask
+        props = self.property_for_bit
+        while mask:
+            bit = mask & -mask
+            prop = props[bit]
+            setattr(self, prop, getattr(other, prop))
+            mask ^= bit
 
     def update(self, other):
-        for prop in self.all_properties:
-            nval = getattr(other, prop)
-            if nval is not inherit:
-                setattr(self, prop, nval)
+        self.copy_properties(other, other.defined_mask)
 
     def apply_bidi(self):
         self.is_bidi = True
@@ -217,18 +341,22 @@ class Style(object):
 class RowStyle(Style):
 
     all_properties = ('height', 'cantSplit', 'hidden', 'spacing',)
+    __slots__ = all_properties
+    property_for_bit = {1 << i: p for i, p in enumerate(all_properties)}
 
     def __init__(self, namespace, trPr=None):
         self.namespace = namespace
+        self.is_bidi = False
         if trPr is None:
             for p in self.all_properties:
                 setattr(self, p, inherit)
+            self.defined_mask = 0
         else:
             for p in ('hidden', 'cantSplit'):
                 setattr(self, p, binary_property(trPr, p, namespace.XPath, namespace.get))
-            for p in ('spacing', 'height'):
-                f = globals()['read_%s' % p]
+            for f in row_readers:
                 f(trPr, self, namespace.XPath, namespace.get)
+            self.init_defined_mask()
         self._css = None
 
     @property
@@ -254,18 +382,20 @@ class CellStyle(Style):
 
     all_properties = ('background_color', 'cell_padding_left', 'cell_padding_right', 'cell_padding_top',
         'cell_padding_bottom', 'width', 'vertical_align', 'col_span', 'vMerge', 'hMerge', 'row_span',
-    ) + tuple(k % edge for edge in border_edges for k in border_props)
+    ) + border_properties
+    __slots__ = all_properties
+    property_for_bit = {1 << i: p for i, p in enumerate(all_properties)}
 
     def __init__(self, namespace, tcPr=None):
         self.namespace = namespace
+        self.is_bidi = False
+        for p in self.all_properties:
+            setattr(self, p, inherit)
         if tcPr is None:
-            for p in self.all_properties:
-                setattr(self, p, inherit)
+            self.defined_mask = 0
         else:
-            for x in ('borders', 'shd', 'padding', 'cell_width', 'vertical_align', 'col_span', 'merge'):
-                f = globals()['read_%s' % x]
-                f(tcPr, self, namespace.XPath, namespace.get)
-            self.row_span = inherit
+            read_cell_properties(tcPr, self, namespace.XPath, namespace.get)
+            self.init_defined_mask()
         self._css = None
 
     @property
@@ -294,48 +424,80 @@ class CellStyle(Style):
         return self._css
 
 
+class Overrides(dict):
+
+    '''
+    The styles for a single type of conditional table formatting, such as
+    firstRow. Most types are never applied to any paragraph, so the paragraph
+    and run styles are only created when first accessed.
+    '''
+
+    def __init__(self, namespace):
+        dict.__init__(self)
+        self.namespace = namespace
+        self.pending = {}
+
+    def defer(self, key, factory, elem):
+        self.pending[key] = (factory, elem)
+
+    def __missing__(self, key):
+        factory, elem = self.pending.pop(key)
+        self[key] = ans = factory(self.namespace, elem)
+        return ans
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.pending
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
 class TableStyle(Style):
 
     all_properties = (
         'width', 'float', 'cell_padding_left', 'cell_padding_right', 'cell_padding_top',
         'cell_padding_bottom', 'margin_left', 'margin_right', 'background_color',
         'spacing', 'indent', 'overrides', 'col_band_size', 'row_band_size', 'look', 'bidi',
-    ) + tuple(k % edge for edge in border_edges for k in border_props)
+    ) + border_properties
+    __slots__ = all_properties + ('page',)
+    property_for_bit = {1 << i: p for i, p in enumerate(all_properties)}
 
     def __init__(self, namespace, tblPr=None):
         self.namespace = namespace
+        self.is_bidi = False
         if tblPr is None:
             for p in self.all_properties:
                 setattr(self, p, inherit)
+            self.defined_mask = 0
         else:
             self.overrides = inherit
             self.bidi = binary_property(tblPr, 'bidiVisual', namespace.XPath, namespace.get)
-            for x in ('width', 'float', 'padding', 'shd', 'justification', 'spacing', 'indent', 'borders', 'band_size', 'look'):
-                f = globals()['read_%s' % x]
+            for f in table_readers:
                 f(tblPr, self, self.namespace.XPath, self.namespace.get)
             parent = tblPr.getparent()
             if self.namespace.is_tag(parent, 'w:style'):
                 self.overrides = {}
                 for tblStylePr in self.namespace.XPath('./w:tblStylePr[@w:type]')(parent):
                     otype = self.namespace.get(tblStylePr, 'w:type')
-                    orides = self.overrides[otype] = {}
-                    for tblPr in self.namespace.XPath('./w:tblPr')(tblStylePr):
+                    orides = self.overrides[otype] = Overrides(self.namespace)
+                    for tblPr in children(tblStylePr, 'tblPr'):
                         orides['table'] = TableStyle(self.namespace, tblPr)
-                    for trPr in self.namespace.XPath('./w:trPr')(tblStylePr):
+                    for trPr in children(tblStylePr, 'trPr'):
                         orides['row'] = RowStyle(self.namespace, trPr)
-                    for tcPr in self.namespace.XPath('./w:tcPr')(tblStylePr):
+                    for tcPr in children(tblStylePr, 'tcPr'):
                         orides['cell'] = CellStyle(self.namespace, tcPr)
-                    for pPr in self.namespace.XPath('./w:pPr')(tblStylePr):
-                        orides['para'] = ParagraphStyle(self.namespace, pPr)
-                    for rPr in self.namespace.XPath('./w:rPr')(tblStylePr):
-                        orides['run'] = RunStyle(self.namespace, rPr)
+                    for pPr in children(tblStylePr, 'pPr'):
+                        orides.defer('para', ParagraphStyle, pPr)
+                    for rPr in children(tblStylePr, 'rPr'):
+                        orides.defer('run', RunStyle, rPr)
+            self.init_defined_mask()
         self._css = None
 
     def resolve_based_on(self, parent):
-        for p in self.all_properties:
-            val = getattr(self, p)
-            if val is inherit:
-                setattr(self, p, getattr(parent, p))
+        self.copy_properties(parent, parent.defined_mask & ~self.defined_mask)
 
     @property
     def css(self):
@@ -375,6 +537,10 @@ class TableStyle(Style):
         return self._css
 
 
+# Whitespace used to indent the generated table markup
+indent1, indent2, indent3 = '\n\t', '\n\t\t', '\n\t\t\t'
+
+
 class Table(object):
 
     def __init__(self, namespace, tbl, styles, para_map, is_sub_table=False):
@@ -385,7 +551,7 @@ class Table(object):
 
         # Read Table Style
         style = {'table':TableStyle(self.namespace)}
-        for tblPr in self.namespace.XPath('./w:tblPr')(tbl):
+        for tblPr in children(tbl, 'tblPr'):
             for ts in self.namespace.XPath('./w:tblStyle[@w:val]')(tblPr):
                 style_id = self.namespace.get(ts, 'w:val')
                 s = styles.get(style_id)
@@ -413,24 +579,25 @@ class Table(object):
 
         self.style_map = {}
         self.paragraphs = []
-        self.cell_map = []
+        # Only needed to handle merged cells, so not kept around
+        cell_map = []
 
-        rows = self.namespace.XPath('./w:tr')(tbl)
+        rows = tuple(children(tbl, 'tr'))
         for r, tr in enumerate(rows):
             overrides = self.get_overrides(r, None, len(rows), None)
             self.resolve_row_style(tr, overrides)
-            cells = self.namespace.XPath('./w:tc')(tr)
-            self.cell_map.append([])
+            cells = tuple(children(tr, 'tc'))
+            cell_map.append([])
             for c, tc in enumerate(cells):
                 overrides = self.get_overrides(r, c, len(rows), len(cells))
                 self.resolve_cell_style(tc, overrides, r, c, len(rows), len(cells))
-                self.cell_map[-1].append(tc)
-                for p in self.namespace.XPath('./w:p')(tc):
+                cell_map[-1].append(tc)
+                for p in children(tc, 'p'):
                     para_map[p] = self
                     self.paragraphs.append(p)
                     self.resolve_para_style(p, overrides)
 
-        self.handle_merged_cells()
+        self.handle_merged_cells(cell_map)
         self.sub_tables = {x:Table(namespace, x, styles, para_map, is_sub_table=True) for x in self.namespace.XPath('./w:tr/w:tc/w:tbl')(tbl)}
 
     @property
@@ -497,7 +664,7 @@ class Table(object):
                 if ors is not None:
                     rs.update(ors)
 
-        for trPr in self.namespace.XPath('./w:trPr')(tr):
+        for trPr in children(tr, 'trPr'):
             rs.update(RowStyle(self.namespace, trPr))
         if self.bidi:
             rs.apply_bidi()
@@ -512,11 +679,10 @@ class Table(object):
                 if ors is not None:
                     cs.update(ors)
 
-        for tcPr in self.namespace.XPath('./w:tcPr')(tc):
+        for tcPr in children(tc, 'tcPr'):
             cs.update(CellStyle(self.namespace, tcPr))
 
-        for x in edges:
-            p = 'cell_padding_%s' % x
+        for x, p, props in cell_edge_properties:
             val = getattr(cs, p)
             if val is inherit:
                 setattr(cs, p, getattr(self.table_style, p))
@@ -527,14 +693,9 @@ class Table(object):
                 (x == 'right' and col < cols_in_row - 1) or
                 (x == 'bottom' and row < rows -1)
             )
-            inside_edge = ('insideH' if x in {'top', 'bottom'} else 'insideV') if is_inside_edge else None
-            for prop in border_props:
-                if not prop.startswith('border'):
-                    continue
-                eprop = prop % x
-                iprop = (prop % inside_edge) if inside_edge else None
+            for eprop, iprop in props:
                 val = getattr(cs, eprop)
-                if val is inherit and iprop is not None:
+                if val is inherit and is_inside_edge:
                     # Use the insideX borders if the main cell borders are not
                     # specified
                     val = getattr(cs, iprop)
@@ -545,6 +706,7 @@ class Table(object):
                     # table border is not null and the cell border is null.
                     val = 'hidden'
                 setattr(cs, eprop, val)
+        cs.init_defined_mask()
 
         if self.bidi:
             cs.apply_bidi()
@@ -565,13 +727,13 @@ class Table(object):
                             text_styles[i].update(ops)
         self.style_map[p] = text_styles
 
-    def handle_merged_cells(self):
-        if not self.cell_map:
+    def handle_merged_cells(self, cell_map):
+        if not cell_map:
             return
         # Handle vMerge
-        max_col_num = max(len(r) for r in self.cell_map)
+        max_col_num = max(len(r) for r in cell_map)
         for c in range(max_col_num):
-            cells = [row[c] if c < len(row) else None for row in self.cell_map]
+            cells = [row[c] if c < len(row) else None for row in cell_map]
             runs = [[]]
             for cell in cells:
                 try:
@@ -586,12 +748,14 @@ class Table(object):
                     runs.append([])
             for run in runs:
                 if len(run) > 1:
-                    self.style_map[run[0]].row_span = len(run)
+                    s = self.style_map[run[0]]
+                    s.row_span = len(run)
+                    s.init_defined_mask()
                     for tc in run[1:]:
                         tc.getparent().remove(tc)
 
         # Handle hMerge
-        for cells in self.cell_map:
+        for cells in cell_map:
             runs = [[]]
             for cell in cells:
                 try:
@@ -610,7 +774,9 @@ class Table(object):
 
             for run in runs:
                 if len(run) > 1:
-                    self.style_map[run[0]].col_span = len(run)
+                    s = self.style_map[run[0]]
+                    s.col_span = len(run)
+                    s.init_defined_mask()
                     for tc in run[1:]:
                         tc.getparent().remove(tc)
 
@@ -622,44 +788,21 @@ class Table(object):
                 yield p
 
     def apply_markup(self, rmap, page, parent=None):
-        table = TABLE('\n\t\t')
-        if self.bidi:
-            table.set('dir', 'rtl')
-        self.table_style.page = page
-        style_map = {}
         if parent is None:
             try:
                 first_para = rmap[next(iter(self))]
             except StopIteration:
                 return
             parent = first_para.getparent()
-            idx = parent.index(first_para)
-            parent.insert(idx, table)
+            table = parent.makeelement('table')
+            parent.insert(parent.index(first_para), table)
         else:
-            parent.append(table)
-        for row in self.namespace.XPath('./w:tr')(self.tbl):
-            tr = TR('\n\t\t\t')
-            style_map[tr] = self.style_map[row]
-            tr.tail = '\n\t\t'
-            table.append(tr)
-            for tc in self.namespace.XPath('./w:tc')(row):
-                td = TD()
-                style_map[td] = s = self.style_map[tc]
-                if s.col_span is not inherit:
-                    td.set('colspan', unicode_type(s.col_span))
-                if s.row_span is not inherit:
-                    td.set('rowspan', unicode_type(s.row_span))
-                td.tail = '\n\t\t\t'
-                tr.append(td)
-                for x in self.namespace.XPath('./w:p|./w:tbl')(tc):
-                    if x.tag.endswith('}p'):
-                        td.append(rmap[x])
-                    else:
-                        self.sub_tables[x].apply_markup(rmap, page, parent=td)
-            if len(tr):
-                tr[-1].tail = '\n\t\t'
-        if len(table):
-            table[-1].tail = '\n\t'
+            table = SubElement(parent, 'table')
+        table.text = indent2
+        if self.bidi:
+            table.set('dir', 'rtl')
+        self.table_style.page = page
+        style_map = self.build_rows(table, rmap, page)
 
         table_style = self.table_style.css
         if table_style:
@@ -669,6 +812,64 @@ class Table(object):
             if css:
                 elem.set('class', self.styles.register(css, elem.tag))
 
+    def build_rows(self, table, rmap, page):
+        'Create the rows and cells of table, returning a map of the created elements to their styles'
+        # The row and cell styles are removed from self.style_map as they are
+        # consumed, so that they can be freed once their CSS has been
+        # registered, only the paragraph styles are needed after this.
+        # This is the hot loop for table heavy documents, so look up
+        # everything that is invariant only once and walk the table in a
+        # single preorder traversal. Elements that are not direct children of
+        # the current table/row/cell, such as the contents of nested tables,
+        # are skipped.
+        style_map, own_styles, sub_tables, tbl = {}, self.style_map, self.sub_tables, self.tbl
+        tr_tag, tc_tag, p_tag, tbl_tag = (self.namespace.expand('w:' + x) for x in ('tr', 'tc', 'p', 'tbl'))
+        row = tc = tr = td = None
+        blocks = []
+        for x in tbl.iter(tr_tag, tc_tag, p_tag, tbl_tag):
+            parent, tag = x.getparent(), x.tag
+            if tag == p_tag:
+                if parent is tc:
+                    blocks.append(rmap[x])
+            elif tag == tc_tag:
+                if parent is row:
+                    if blocks:
+                        td.extend(blocks)
+                        blocks = []
+                    tc = x
+                    td = SubElement(tr, 'td')
+                    td.tail = indent3
+                    style_map[td] = s = own_styles.pop(tc)
+                    if s.col_span is not inherit:
+                        td.set('colspan', unicode_type(s.col_span))
+                    if s.row_span is not inherit:
+                        td.set('rowspan', unicode_type(s.row_span))
+            elif tag == tr_tag:
+                if parent is tbl:
+                    if blocks:
+                        td.extend(blocks)
+                        blocks = []
+                    if td is not None:
+                        td.tail = indent2
+                    row, tc, td = x, None, None
+                    tr = SubElement(table, 'tr')
+                    tr.text = indent3
+                    tr.tail = indent2
+                    style_map[tr] = own_styles.pop(row)
+            elif parent is tc and tc is not None:
+                # A nested table
+                if blocks:
+                    td.extend(blocks)
+                    blocks = []
+                sub_tables[x].apply_markup(rmap, page, parent=td)
+        if blocks:
+            td.extend(blocks)
+        if td is not None:
+            td.tail = indent2
+        if tr is not None:
+            tr.tail = indent1
+        return style_map
+
 
 class Tables(object):
 
@@ -685,7 +886,10 @@ class Tables(object):
         self.sub_tables |= set(self.tables[-1].sub_tables)
 
     def apply_markup(self, object_map, page_map):
-        rmap = {v:k for k, v in iteritems(object_map)}
+        # Only the paragraphs inside tables are needed, object_map also
+        # contains every run and every paragraph outside tables
+        para_map = self.para_map
+        rmap = {v:k for k, v in iteritems(object_map) if v in para_map}
         for table in self.tables:
             table.apply_markup(rmap, page_map[table.tbl])
 
@@ -698,3 +902,108 @@ class Tables(object):
         table = self.para_map.get(p, None)
         if table is not None:
             return table.style_map.get(p, (None, None))[1]
+
+
+def test_tables(return_tests=False):
+    import unittest
+    from lxml import etree
+    from calibre.ebooks.docx.names import DOCXNamespace
+
+    class Styles(dict):
+
+        def register(self, css, tag):
+            return tag
+
+    class Page(object):
+        width, margin_left, margin_right = 612, 72, 72
+
+    class TestTables(unittest.TestCase):
+
+        def render(self, body):
+            # Convert the w:body markup in body to HTML, returning the HTML
+            # body element and the Tables object
+            ns = DOCXNamespace()
+            root = etree.fromstring('<w:body xmlns:w="%s">%s</w:body>' % (ns.namespaces['w'], body))
+            html = etree.Element('body')
+            object_map, page_map = {}, {}
+            for p in ns.XPath('//w:p')(root):
+                object_map[SubElement(html, 'p')] = p
+                # The test paragraphs contain only their text
+                html[-1].text = p.text
+            tables = Tables(ns)
+            for tbl in ns.XPath('./w:tbl')(root):
+                tables.register(tbl, Styles())
+            for tbl in ns.XPath('//w:tbl')(root):
+                page_map[tbl] = Page()
+            tables.apply_markup(object_map, page_map)
+            return html, tables
+
+        def structure(self, elem):
+            # A nested list representation of the table markup in elem
+            if elem.tag == 'p':
+                return elem.text
+            return [self.structure(x) for x in elem]
+
+        def test_order(self):
+            html, tables = self.render(
+                '<w:p>before</w:p><w:tbl><w:tblPr/><w:tr>'
+                '<w:tc><w:p>a</w:p><w:p>b</w:p></w:tc><w:tc><w:p>c</w:p></w:tc></w:tr>'
+                '<w:tr><w:tc><w:p>d</w:p>'
+                '<w:tbl><w:tblPr/><w:tr><w:tc><w:p>x</w:p></w:tc><w:tc><w:p>y</w:p></w:tc></w:tr></w:tbl>'
+                '<w:p>e</w:p></w:tc></w:tr></w:tbl><w:p>after</w:p>')
+            self.assertEqual(self.structure(html), [
+                'before', [[['a', 'b'], ['c']], [['d', [[['x'], ['y']]], 'e']]], 'after'])
+            self.assertEqual(len(tables.tables), 1)
+
+        def test_merged_cells(self):
+            html = self.render(
+                '<w:tbl><w:tblPr/><w:tr>'
+                '<w:tc><w:tcPr><w:vMerge w:val="restart"/></w:tcPr><w:p>a</w:p></w:tc>'
+                '<w:tc><w:tcPr><w:hMerge w:val="restart"/></w:tcPr><w:p>b</w:p></w:tc>'
+                '<w:tc><w:tcPr><w:hMerge/></w:tcPr><w:p>c</w:p></w:tc></w:tr>'
+                '<w:tr><w:tc><w:tcPr><w:vMerge/></w:tcPr><w:p>d</w:p></w:tc>'
+                '<w:tc><w:tcPr><w:gridSpan w:val="2"/></w:tcPr><w:p>e</w:p></w:tc></w:tr></w:tbl>')[0]
+            # The contents of the merged away cells are not moved into the table
+            self.assertEqual(self.structure(html), [[[['a'], ['b']], [['e']]], 'c', 'd'])
+            rows = html[0].findall('tr')
+            self.assertEqual([dict(td.attrib) for td in rows[0]], [
+                {'rowspan': '2', 'class': 'td'}, {'colspan': '2', 'class': 'td'}])
+            self.assertEqual(dict(rows[1][0].attrib), {'colspan': '2', 'class': 'td'})
+
+        def test_overrides(self):
+            ns = DOCXNamespace()
+            tblPr = etree.fromstring(
+                '<w:style xmlns:w="%s"><w:tblPr/><w:tblStylePr w:type="firstRow">'
+                '<w:pPr><w:jc w:val="center"/></w:pPr><w:rPr><w:b/></w:rPr>'
+                '</w:tblStylePr></w:style>' % ns.namespaces['w'])[0]
+            o = TableStyle(ns, tblPr).overrides['firstRow']
+            self.assertIn('para', o)
+            self.assertIn('run', o)
+            self.assertNotIn('cell', o)
+            self.assertIsNone(o.get('cell'))
+            self.assertRaises(KeyError, lambda: o['cell'])
+            self.assertEqual(o.get('para').text_align, 'center')
+            self.assertIs(o['para'], o.get('para'))
+            self.assertTrue(o['run'].b)
+            self.assertIn('run', o)
+
+        def test_width(self):
+            ae = lambda typ, w, ans: self.assertEqual(_compute_width(typ, w), ans)
+            ae('dxa', 2880, '144pt')
+            ae('dxa', -2880, '-144pt')
+            ae('dxa', 1234, '61.7pt')
+            ae('dxa', 20000, '1e+03pt')
+            ae('pct', 5000, '100%')
+            ae('pct', 1728, '34.6%')
+            ae('pct', 60000, '1.2e+03%')
+            ae('auto', 0, 'auto')
+            ae('nil', 0, '0')
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTables)
+    if return_tests:
+        return suite
+    unittest.TextTestRunner(verbosity=4).run(suite)
+
+
+if __name__ == '__main__':
+    test_tables()